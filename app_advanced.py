@@ -1,74 +1,386 @@
 import streamlit as st
-import json
-import re
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import time
+import orjson
+import ijson
+import tempfile
+import threading
+import queue
+from contextlib import contextmanager
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from jinja2 import Template
 from openai import OpenAI
 from duckduckgo_search import DDGS
+from duckduckgo_search.exceptions import RatelimitException
+
+# 可选：安装 google-re2 后使用线性时间的 RE2 引擎扫描超大情报文本，否则回退标准库 re
+try:
+    import re2 as _re_engine
+except ImportError:
+    import re as _re_engine
 
 # ==========================================
 # 1. 工具函数与配置
 # ==========================================
 
-@st.cache_data(ttl=3600)
-def get_cisa_kev_set():
-    """从 CISA 获取已知被利用漏洞列表 (缓存1小时)"""
-    url = "https://www.cisa.gov/sites/default/files/feeds/known_exploited_vulnerabilities.json"
+# 并发调查的线程数
+ENRICH_MAX_WORKERS = 4
+
+class TokenBucket:
+    """线程安全的令牌桶限速器：允许短时突发，长期平均速率不超过 rate (次/秒)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens=1):
+        """取令牌，桶空时仅等待补足所需的时间"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, tokens=1):
+        """被限流时额外扣除令牌 (允许为负)，拉长后续请求的等待时间"""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+
+@st.cache_resource(show_spinner=False)
+def _get_search_limiter():
+    """
+    进程级 DDG 限速器，跨 rerun 与会话共享 (模块级变量每次 rerun 都会重建)：
+    令牌桶突发 3 次、之后平均每 5 秒 1 次；信号量限制同时在途的搜索请求数为 2。
+    """
+    return TokenBucket(rate=0.2, capacity=3), threading.BoundedSemaphore(2)
+
+# 批量搜索：每次查询合并的 CVE 数、单次拉取的结果数、每个 CVE 保留的结果数
+SEARCH_BATCH_SIZE = 5
+SEARCH_BATCH_RESULTS = 15
+SEARCH_RESULTS_PER_CVE = 3
+
+# 流式接收时：每 N 个数据块刷新进度条 / 尝试提前解析 JSON
+STREAM_PROGRESS_EVERY = 32
+STREAM_PARSE_EVERY = 256
+
+# 超过该大小的 HTML 报告默认不做 iframe 预览
+PREVIEW_MAX_CHARS = 200_000
+
+# 预编译正则，避免每次调用重复查找/编译 (用内联 (?i) 忽略大小写，re / re2 通用)
+_CVE_RE = _re_engine.compile(r"(?i)CVE-\d{4}-\d{4,7}")
+
+@st.cache_resource(show_spinner=False)
+def _get_http_session():
+    """进程级连接池会话：跨 rerun 复用 keep-alive 连接，避免每次请求重新握手"""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4, pool_maxsize=4,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    ))
+    return session
+
+CISA_KEV_URL = "https://www.cisa.gov/sites/default/files/feeds/known_exploited_vulnerabilities.json"
+# KEV 本地磁盘缓存，跨进程/重启复用，配合 ETag 条件请求
+KEV_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "vuln-assessment-assistant")
+KEV_CACHE_PATH = os.path.join(KEV_CACHE_DIR, "kev.json")
+KEV_META_PATH = os.path.join(KEV_CACHE_DIR, "kev.etag")
+KEV_TTL = 3600
+
+def _parse_kev_file(path):
+    """流式解析 KEV 文件，只提取 cveID 字段；JSON 不完整时抛出 ijson.JSONError"""
+    with open(path, "rb") as f:
+        return frozenset(v.upper() for v in ijson.items(f, "vulnerabilities.item.cveID"))
+
+def _load_kev_cache():
+    """读取本地 KEV 缓存 (不存在或损坏时返回 None，不向上抛出异常)"""
     try:
-        resp = requests.get(url, timeout=5)
-        if resp.status_code == 200:
-            data = resp.json()
-            return {item['cveID'].upper() for item in data['vulnerabilities']}
+        return _parse_kev_file(KEV_CACHE_PATH)
+    except OSError:
+        return None
+    except Exception as e:
+        # 缓存文件损坏 (残缺 JSON、字段类型异常等)
+        print(f"CISA KEV cache unreadable: {e}")
+        return None
+
+def _download_kev(resp):
+    """
+    流式下载 KEV 到临时文件，解析成功后再原子替换本地缓存并记录 ETag / Last-Modified。
+    下载中断导致的残缺 JSON 会在解析时报错，不会覆盖已有的完好缓存。
+    临时文件名唯一 (多进程并发下载互不干扰)，失败时也会被清理。
+    """
+    os.makedirs(KEV_CACHE_DIR, exist_ok=True)
+    part = tempfile.NamedTemporaryFile(dir=KEV_CACHE_DIR, suffix=".part", delete=False)
+    try:
+        with part:
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                part.write(chunk)
+        kev = _parse_kev_file(part.name)
+        os.replace(part.name, KEV_CACHE_PATH)
+    finally:
+        # 解析成功时已被 replace 移走，失败时在此删除
+        if os.path.exists(part.name):
+            os.unlink(part.name)
+    meta = {k: resp.headers[k] for k in ("ETag", "Last-Modified") if k in resp.headers}
+    with open(KEV_META_PATH, "wb") as f:
+        f.write(orjson.dumps(meta))
+    return kev
+
+def _kev_conditional_headers():
+    """根据本地缓存生成 If-None-Match / If-Modified-Since 请求头"""
+    if not os.path.exists(KEV_CACHE_PATH):
+        return {}
+    try:
+        with open(KEV_META_PATH, "rb") as f:
+            meta = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    headers = {}
+    if meta.get("ETag"):
+        headers["If-None-Match"] = meta["ETag"]
+    if meta.get("Last-Modified"):
+        headers["If-Modified-Since"] = meta["Last-Modified"]
+    return headers
+
+@st.cache_data(ttl=KEV_TTL)
+def _fetch_cisa_kev_set():
+    """从 CISA 获取已知被利用漏洞列表 (内存缓存1小时，磁盘缓存 + ETag 校验)"""
+    kev = None
+    try:
+        with _get_http_session().get(CISA_KEV_URL, headers=_kev_conditional_headers(), stream=True, timeout=5) as resp:
+            if resp.status_code == 304:
+                # 远端未更新，直接复用本地缓存
+                kev = _load_kev_cache()
+            elif resp.status_code == 200:
+                kev = _download_kev(resp)
     except Exception as e:
         print(f"CISA KEV Warning: {e}")
-    return set()
+    
+    if kev is None:
+        # 网络异常或数据残缺时回退到本地缓存 (可能略旧，但优于空集合)
+        kev = _load_kev_cache()
+    if kev is None:
+        # 抛出异常而非返回空集合：st.cache_data 不缓存异常，下次调用会重新拉取
+        raise RuntimeError("CISA KEV unavailable (network and local cache both failed)")
+    return kev
+
+def get_cisa_kev_set():
+    """
+    获取 KEV 集合 (frozenset，可在线程间安全共享)，返回 (集合, 是否可用)。
+    不可用时返回空集合与 False，调用方据此判断结果是否可信。
+    """
+    try:
+        return _fetch_cisa_kev_set(), True
+    except RuntimeError as e:
+        print(f"CISA KEV Warning: {e}")
+        return frozenset(), False
+
+@st.cache_resource(show_spinner=False)
+def _get_ddgs_pool():
+    """进程级 DDGS 客户端池：跨 rerun / 线程复用 keep-alive 连接，避免重复 TLS 握手"""
+    return queue.Queue()
+
+@contextmanager
+def _borrow_ddgs():
+    """从池中借出一个 DDGS 客户端 (池空时新建)，用完归还"""
+    pool = _get_ddgs_pool()
+    try:
+        ddgs = pool.get_nowait()
+    except queue.Empty:
+        ddgs = DDGS()
+    try:
+        yield ddgs
+    finally:
+        pool.put(ddgs)
+
+def _ddg_text(query, max_results):
+    """执行一次限速后的 DDG 搜索，返回原始结果列表 (异常向上抛出)"""
+    bucket, sem = _get_search_limiter()
+    bucket.acquire()
+    try:
+        # 在信号量内借出客户端，池大小因此不会超过并发上限
+        with sem, _borrow_ddgs() as ddgs:
+            return ddgs.text(query, max_results=max_results) or []
+    except RatelimitException:
+        # DDG 返回 202/429 限流，退避：多扣令牌
+        bucket.penalize(bucket.capacity)
+        raise
+
+def _format_results(results):
+    """将搜索结果格式化为上下文文本"""
+    context = "".join(
+        f"- Title: {r['title']}\n  Snippet: {r['body']}\n" for r in results
+    )
+    return context if context else "No relevant search results found."
+
+def _search_web(query, max_results=3):
+    """执行一次限速后的 DDG 搜索并格式化结果 (异常向上抛出)"""
+    return _format_results(_ddg_text(query, max_results))
 
 def search_web_context(query, max_results=3):
     """搜索网络获取上下文 (容错处理)"""
     try:
-        results = DDGS().text(query, max_results=max_results)
-        context = ""
-        if results:
-            for r in results:
-                context += f"- Title: {r['title']}\n  Snippet: {r['body']}\n"
-        return context if context else "No relevant search results found."
+        return _search_web(query, max_results)
     except Exception as e:
         return f"Search skipped due to error: {e}"
 
+@st.cache_data(ttl=24 * 3600, show_spinner=False)
+def _cached_cve_context(cve):
+    # 优化搜索词：CVE + exploit + cvss
+    # 搜索失败会抛异常，st.cache_data 不缓存异常，避免错误结果被缓存一整天
+    return _search_web(f"{cve} vulnerability exploit poc cvss score github")
+
+def fetch_cve_context(cve):
+    """按 CVE 编号获取搜索上下文 (跨会话缓存24小时)，返回 {cve: context}；失败时抛出异常"""
+    return {cve: _cached_cve_context(cve)}
+
+@st.cache_data(ttl=24 * 3600, show_spinner=False)
+def _cached_batch_context(cves):
+    # 多个 CVE 合并为一次 OR 查询，再按结果中出现的 CVE 编号分拣 (精确匹配，避免前缀误判)
+    query = " OR ".join(cves) + " exploit poc cvss"
+    matched = {cve: [] for cve in cves}
+    for r in _ddg_text(query, max_results=SEARCH_BATCH_RESULTS):
+        mentioned = {m.upper() for m in _CVE_RE.findall(f"{r['title']} {r['body']}")}
+        for cve in cves:
+            if cve in mentioned and len(matched[cve]) < SEARCH_RESULTS_PER_CVE:
+                matched[cve].append(r)
+    return {cve: _format_results(rs) for cve, rs in matched.items() if rs}
+
+def fetch_batch_context(cves):
+    """批量获取一组 CVE 的搜索上下文，返回 {cve: context} (仅含命中的 CVE)；失败时抛出异常"""
+    return _cached_batch_context(tuple(cves))
+
+def collect_search_contexts(cve_list, executor, on_progress=None):
+    """
+    并发获取全部 CVE 的搜索上下文，返回 ({cve: context}, 搜索失败的 CVE 列表)。
+    每 SEARCH_BATCH_SIZE 个 CVE 合并为一次搜索，把 DDG 请求数从 N 降到 ⌈N/批大小⌉；
+    批量查询成功但未命中的 CVE 再单独补查 (同样提交到线程池并发执行)。
+    批量查询失败 (含限流) 时整批标记为跳过，不再逐个重试；一旦被限流也不再补查，避免对已拒绝服务的 DDG 追加请求。
+    on_progress(done, total) 在调用线程中回调，可安全更新 Streamlit 元素。
+    """
+    contexts = {}
+    pending = {}
+    for i in range(0, len(cve_list), SEARCH_BATCH_SIZE):
+        batch = cve_list[i:i + SEARCH_BATCH_SIZE]
+        if len(batch) > 1:
+            pending[executor.submit(fetch_batch_context, batch)] = batch
+        else:
+            pending[executor.submit(fetch_cve_context, batch[0])] = batch
+    
+    failed = []
+    rate_limited = None
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            batch = pending.pop(future)
+            try:
+                found = future.result()
+            except Exception as e:
+                if isinstance(e, RatelimitException):
+                    rate_limited = e
+                for cve in batch:
+                    contexts[cve] = f"Search skipped due to error: {e}"
+                failed.extend(batch)
+                continue
+            contexts.update(found)
+            for cve in batch:
+                if cve in found:
+                    continue
+                if rate_limited is not None:
+                    # 已被限流，不再补查
+                    contexts[cve] = f"Search skipped due to error: {rate_limited}"
+                    failed.append(cve)
+                else:
+                    pending[executor.submit(fetch_cve_context, cve)] = [cve]
+        if on_progress:
+            on_progress(len(contexts), len(cve_list))
+    return contexts, failed
+
 def extract_cves(text):
-    """正则提取 CVE 编号"""
-    return list(set(re.findall(r"(CVE-\d{4}-\d{4,7})", text, re.IGNORECASE)))
+    """正则提取 CVE 编号 (统一大写、去重，保留首次出现的顺序)"""
+    return list(dict.fromkeys(m.upper() for m in _CVE_RE.findall(text)))
+
+def _find_json_array(text, start=0):
+    """
+    括号深度扫描：定位 start 之后第一个完整闭合的 [...] 片段。
+    会跳过字符串字面量中的括号及转义字符，返回 (起, 止) 下标；未闭合时返回 None。
+    """
+    i = text.find("[", start)
+    if i == -1:
+        return None
+    depth = 0
+    in_str = False
+    escaped = False
+    for j in range(i, len(text)):
+        ch = text[j]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "[":
+            depth += 1
+        elif ch == "]":
+            depth -= 1
+            if depth == 0:
+                return i, j + 1
+    return None
+
+def _is_vuln_list(data):
+    """研判结果必须是非空的字典列表"""
+    return isinstance(data, list) and bool(data) and all(isinstance(x, dict) for x in data)
+
+def _scan_vuln_list(text):
+    """
+    单遍扫描定位 [...] 列表，只解析该片段。
+    前言中的 "[1]" 等片段或解析失败的片段整体跳过，从其结尾继续向后查找。
+    """
+    pos = 0
+    while True:
+        span = _find_json_array(text, pos)
+        if span is None:
+            return None
+        try:
+            data = orjson.loads(text[span[0]:span[1]])
+        except ValueError:
+            data = None
+        if _is_vuln_list(data):
+            return data
+        pos = span[1]
 
 def extract_json_from_text(text):
     """
     鲁棒性优化：从模型返回的文本中提取 JSON 列表。
     解决模型可能返回 Markdown 代码块或前言废话的问题。
     """
-    try:
-        # 1. 尝试直接解析
-        return json.loads(text)
-    except json.JSONDecodeError:
-        pass
+    # 1. 直接扫描原文 (扫描从第一个 [ 开始，包裹列表的代码块标记不影响解析；
+    #    也不会误删字段值中的 ``` 内容)
+    data = _scan_vuln_list(text)
+    if data is not None:
+        return data
 
-    # 2. 尝试去除 Markdown 代码块标记
-    clean_text = text.replace("```json", "").replace("```", "").strip()
-    try:
-        return json.loads(clean_text)
-    except json.JSONDecodeError:
-        pass
-
-    # 3. 正则暴力提取 [...] 列表结构
-    # 寻找第一个 [ 和 最后一个 ]
-    match = re.search(r"(\[.*\])", text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group(1))
-        except:
-            pass
-            
-    return None
+    # 2. 兜底：去除 Markdown 代码块标记后再扫描一次
+    return _scan_vuln_list(text.replace("```json", "").replace("```", ""))
 
 # ==========================================
 # 2. 核心研判逻辑 (AI Agent)
@@ -101,83 +413,166 @@ SYSTEM_PROMPT = """
 ]
 """
 
-def run_analysis(client, raw_text, model_name, enable_search=True):
+# 系统消息保持为模块级常量并始终置于首位，确保请求前缀稳定，
+# 便于 DeepSeek / OpenAI 的自动前缀缓存 (Prompt Caching) 命中
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+PROMPT_CACHE_KEY = "vuln_triage_v1"
+
+def _prompt_cache_kwargs(client):
+    """仅 OpenAI 官方接口支持 prompt_cache_key，其余兼容接口不传以免报错"""
+    if "api.openai.com" in str(client.base_url):
+        return {"extra_body": {"prompt_cache_key": PROMPT_CACHE_KEY}}
+    return {}
+
+def _enrich_one(cve, cisa_kev, search_context):
+    """格式化单个 CVE 的情报块 (KEV 检查 + 搜索上下文)"""
+    is_kev = cve in cisa_kev
+    kev_str = "YES (Must be P0, Critical)" if is_kev else "No"
+    return (
+        f"--- Vulnerability: {cve} ---\n"
+        f"[CISA KEV Database Hit]: {kev_str}\n"
+        f"[Internet Search Context]:\n{search_context}\n\n"
+    )
+
+class AnalysisParseError(Exception):
+    """模型返回内容无法解析为 JSON 列表 (携带原始返回以便展示)"""
+
+    def __init__(self, content):
+        super().__init__("AI 返回的数据格式不正确")
+        self.content = content
+
+class DegradedAnalysisResult(Exception):
+    """
+    外部情报 (KEV / 联网搜索) 获取失败时得到的研判结果。
+    以异常形式返回，st.cache_data 不会缓存，外部服务恢复后重新研判即可得到完整结果。
+    """
+
+    def __init__(self, data, reasons):
+        super().__init__("; ".join(reasons))
+        self.data = data
+        self.reasons = reasons
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _run_analysis_cached(_client, raw_text, model_name, enable_search, api_base):
+    """
+    研判主流程，按 (原始情报, 模型, 联网开关, 接口地址) 缓存1小时。
+    _client 以下划线开头不参与缓存键，API Key 不会进入缓存；失败时抛出异常，不会被缓存。
+    """
     cve_list = extract_cves(raw_text)
-    cisa_kev = get_cisa_kev_set()
+    cisa_kev, kev_ok = get_cisa_kev_set()
+    degraded_reasons = [] if kev_ok else ["CISA KEV 数据获取失败"]
     
     # 进度条
     progress_text = "正在初始化分析引擎..."
     my_bar = st.progress(0, text=progress_text)
     
     # 构建增强上下文
-    enriched_info = f"【用户提供的原始情报】\n{raw_text}\n\n【系统自动补充的外部情报】\n"
+    parts = [f"【用户提供的原始情报】\n{raw_text}\n\n【系统自动补充的外部情报】\n"]
     
     total_steps = len(cve_list) if cve_list else 1
     
     if cve_list:
-        for idx, cve in enumerate(cve_list):
-            cve = cve.upper()
-            my_bar.progress(int((idx / total_steps) * 80), text=f"🔍 正在调查 {cve} ...")
-            
-            # 1. KEV 检查
-            is_kev = cve in cisa_kev
-            kev_str = "YES (Must be P0, Critical)" if is_kev else "No"
-            
-            # 2. 联网搜索
-            search_context = "Search Disabled"
-            if enable_search:
-                # 优化搜索词：CVE + exploit + cvss
-                query = f"{cve} vulnerability exploit poc cvss score github"
-                search_context = search_web_context(query)
-                time.sleep(0.5) # 稍微节流避免触发反爬
-            
-            enriched_info += f"--- Vulnerability: {cve} ---\n"
-            enriched_info += f"[CISA KEV Database Hit]: {kev_str}\n"
-            enriched_info += f"[Internet Search Context]:\n{search_context}\n\n"
+        my_bar.progress(0, text=f"🔍 正在并发调查 {total_steps} 个漏洞 ...")
+        contexts = {}
+        if enable_search:
+            def on_progress(done, total):
+                my_bar.progress(int((done / total) * 80), text=f"🔍 已完成 {done}/{total} 个漏洞")
+            # 联网搜索为 IO 密集型，多线程并发调查；进度条只在主线程更新
+            with ThreadPoolExecutor(max_workers=ENRICH_MAX_WORKERS) as executor:
+                contexts, failed = collect_search_contexts(cve_list, executor, on_progress)
+            if failed:
+                degraded_reasons.append(f"{len(failed)} 个漏洞联网搜索失败")
+        
+        # 按原始顺序拼接，保证上下文稳定
+        parts.extend(
+            _enrich_one(cve, cisa_kev, contexts.get(cve, "Search Disabled")) for cve in cve_list
+        )
     else:
-        enriched_info += "(未检测到 CVE 编号，仅根据文本描述分析)"
+        parts.append("(未检测到 CVE 编号，仅根据文本描述分析)")
+    enriched_info = "".join(parts)
 
     # AI 推理
     my_bar.progress(90, text=f"🤖 正在调用 {model_name} 进行研判...")
     
     try:
-        response = client.chat.completions.create(
+        stream = _client.chat.completions.create(
             model=model_name,
             messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
+                SYSTEM_MSG,
                 {"role": "user", "content": enriched_info}
             ],
             temperature=0.3, # 降低温度以保证 JSON 格式稳定
             # 移除 response_format 以兼容 DeepSeek/Qwen 等模型
+            stream=True,
+            **_prompt_cache_kwargs(_client),
         )
         
-        content = response.choices[0].message.content
-        
-        # 鲁棒的 JSON 提取
-        data = extract_json_from_text(content)
-        
+        # 流式接收：边生成边尝试解析，JSON 列表一旦闭合即停止等待剩余输出
+        chunks = []
+        data = None
+        n_chunks = 0
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                chunks.append(delta)
+                n_chunks += 1
+                if n_chunks % STREAM_PROGRESS_EVERY == 0:
+                    my_bar.progress(90, text=f"🤖 {model_name} 正在生成研判结果... (已接收 {n_chunks} 个数据块)")
+                if n_chunks % STREAM_PARSE_EVERY == 0:
+                    data = extract_json_from_text("".join(chunks))
+                    # 仅在得到完整的研判结果 (非空字典列表) 时提前结束
+                    if _is_vuln_list(data):
+                        break
+        finally:
+            stream.close()
+    finally:
         my_bar.empty()
-        
-        if not data:
-            st.error("AI 返回的数据格式不正确，无法解析为 JSON。请查看下方原始返回内容。")
-            with st.expander("查看 AI 原始返回"):
-                st.text(content)
-            return []
-            
-        return data
+    
+    content = "".join(chunks)
+    
+    # 鲁棒的 JSON 提取
+    if data is None:
+        data = extract_json_from_text(content)
+    if not data:
+        raise AnalysisParseError(content)
+    if degraded_reasons:
+        # 基于残缺情报的结论不进缓存
+        raise DegradedAnalysisResult(data, degraded_reasons)
+    return data
 
+def run_analysis(client, raw_text, model_name, enable_search=True):
+    """研判入口：命中缓存直接返回；外部情报缺失时提示并返回 (不缓存的) 结果；失败时展示错误并返回空列表"""
+    try:
+        return _run_analysis_cached(client, raw_text, model_name, enable_search, str(client.base_url))
+    except DegradedAnalysisResult as e:
+        st.warning(f"⚠️ 部分外部情报获取失败 ({e})，本次结果可能不完整且未缓存，建议稍后重新研判。")
+        return e.data
+    except AnalysisParseError as e:
+        st.error("AI 返回的数据格式不正确，无法解析为 JSON。请查看下方原始返回内容。")
+        with st.expander("查看 AI 原始返回"):
+            st.text(e.content)
+        return []
     except Exception as e:
-        my_bar.empty()
         st.error(f"API 调用失败: {str(e)}")
         return []
 
+@st.cache_resource(show_spinner=False)
+def _get_template():
+    """读取并编译报告模板 (跨 rerun 仅编译一次；文件缺失时抛出异常，不会被缓存)"""
+    with open("template.html", "r", encoding="utf-8") as f:
+        return Template(f.read())
+
 def generate_html(vuln_data):
+    # 原始数据随报告内嵌一份，便于下游脚本解析；转义 "</" 防止提前闭合 <script>
+    data_json = orjson.dumps(vuln_data).decode().replace("</", "<\\/")
     try:
-        with open("template.html", "r", encoding="utf-8") as f:
-            template_str = f.read()
-        template = Template(template_str)
-        return template.render(
+        return _get_template().render(
             vulns=vuln_data,
+            data_json=data_json,
             generate_time=datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
         )
     except FileNotFoundError:
@@ -238,19 +633,22 @@ Google Chrome V8 类型混淆漏洞(CVE-2025-13223)"""
             
             if results:
                 st.session_state['results'] = results
+                # 报告只在结果变化时渲染一次，后续控件交互引发的 rerun 直接复用
+                st.session_state['html_out'] = generate_html(results)
+                st.session_state['json_out'] = orjson.dumps(results, option=orjson.OPT_INDENT_2)
                 st.toast(f"研判完成！已分析 {len(results)} 个漏洞", icon="✅")
 
 # --- 结果展示区域 ---
 if 'results' in st.session_state:
     data = st.session_state['results']
-    html_out = generate_html(data)
+    html_out = st.session_state['html_out']
     
     with col2:
         st.subheader("2. 研判报告")
         
-        # 统计 Dashboard
-        p0 = len([x for x in data if x.get('level') == 'P0'])
-        p1 = len([x for x in data if x.get('level') == 'P1'])
+        # 统计 Dashboard (单次遍历；模型偶尔返回 ["P0"] 等非字符串等级，不可哈希，跳过不计)
+        level_counts = Counter(x['level'] for x in data if isinstance(x.get('level'), str))
+        p0, p1, total = level_counts.get('P0', 0), level_counts.get('P1', 0), len(data)
         
         # 动态颜色
         status_color = "#dc3545" if p0 > 0 else ("#fd7e14" if p1 > 0 else "#28a745")
@@ -259,7 +657,7 @@ if 'results' in st.session_state:
         st.markdown(f"""
         <div style="padding:15px; background-color:{status_color}15; border:1px solid {status_color}; border-radius:8px; text-align:center; margin-bottom:15px;">
             <h3 style="color:{status_color}; margin:0;">{status_text}</h3>
-            <p style="margin:5px 0 0 0; color:#666;">P0: {p0} | P1: {p1} | 总计: {len(data)}</p>
+            <p style="margin:5px 0 0 0; color:#666;">P0: {p0} | P1: {p1} | 总计: {total}</p>
         </div>
         """, unsafe_allow_html=True)
         
@@ -273,8 +671,19 @@ if 'results' in st.session_state:
                 mime="text/html",
                 use_container_width=True
             )
-            # 使用 iframe 预览
-            st.components.v1.html(html_out, height=600, scrolling=True)
+            # 使用 iframe 预览 (每次 rerun 都会把整份 HTML 发往浏览器，大报告默认关闭)
+            is_large = len(html_out) > PREVIEW_MAX_CHARS
+            if st.checkbox("实时预览", value=not is_large, help="报告较大时建议下载后查看"):
+                st.components.v1.html(html_out, height=600, scrolling=True)
+            elif is_large:
+                st.caption("报告较大，已默认关闭在线预览，请下载后查看。")
             
         with tab_json:
+            st.download_button(
+                "📥 下载 JSON 数据",
+                st.session_state['json_out'],
+                file_name=f"report_{datetime.date.today()}.json",
+                mime="application/json",
+                use_container_width=True
+            )
             st.json(data)